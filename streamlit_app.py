@@ -1,12 +1,18 @@
 import streamlit as st
 import yfinance as yf
 import pandas as pd
+import numpy as np
 import plotly.express as px
 import plotly.graph_objects as go
 import sqlite3
 import time
-from datetime import datetime
+import json
+from datetime import datetime, timedelta, timezone
 import threading
+import asyncio
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+import aiohttp
 
 # If you want scheduling:
 try:
@@ -14,6 +20,19 @@ try:
 except ImportError:
     pass
 
+# Faster JSON decoding for the Yahoo responses, if available:
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+# Persistent on-disk cache for yfinance (survives Streamlit restarts):
+try:
+    import yfinance_cache as yfc
+except ImportError:
+    yfc = None
+
 # --------------------------------------------------
 # CONFIG
 # --------------------------------------------------
@@ -24,21 +43,48 @@ st.set_page_config(
 
 DB_NAME = "options_data.db"
 SYMBOLS = ["AAPL", "TSLA", "MSFT", "AMZN", "SPY", "QQQ", "NVDA", "META", "GOOGL"]
+FETCH_WORKERS = 8
+# How long a fetched options snapshot is served from st.cache_data
+REFRESH_INTERVAL_SEC = 300
+# Direct Yahoo endpoints for the async options fetch
+YAHOO_OPTIONS_URL = "https://query2.finance.yahoo.com/v7/finance/options/{symbol}"
+YAHOO_COOKIE_URL = "https://fc.yahoo.com"
+YAHOO_CRUMB_URL = "https://query2.finance.yahoo.com/v1/test/getcrumb"
+USER_AGENT = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+    "(KHTML, like Gecko) Chrome/120.0 Safari/537.36"
+)
+MAX_CONNECTIONS = 32
+# Per-request cap so one stalled Yahoo request can't hold a fetch for aiohttp's default 5 minutes
+REQUEST_TIMEOUT_SEC = 30
+# Same politeness as the threaded path: at most FETCH_WORKERS requests in flight,
+# each followed by a courtesy delay, so the async fetch doesn't trip Yahoo's 429s.
+MAX_CONCURRENT_REQUESTS = FETCH_WORKERS
+REQUEST_DELAY_SEC = 0.2
+# How stale cached intraday bars may get before yfinance-cache refetches them.
+# Other intervals use yfinance-cache's own default (tied to the bar length).
+INTRADAY_MAX_AGE = {
+    "1m": timedelta(minutes=1),
+    "5m": timedelta(minutes=5),
+}
 
 if "scheduler_running" not in st.session_state:
     st.session_state.scheduler_running = False
+if "scheduler_stop" not in st.session_state:
+    st.session_state.scheduler_stop = None
 if "refresh_count" not in st.session_state:
     st.session_state.refresh_count = 0
 
 # --------------------------------------------------
 # HELPER: MULTISELECT WITH "ALL"
 # --------------------------------------------------
-def multiselect_with_all(label, options, sidebar=True):
+def multiselect_with_all(label, options, sidebar=True, presorted=False):
     """
     A helper function that shows a multiselect box with an "All" option.
     If "All" is chosen, returns the full list. Otherwise, returns the chosen subset.
+    Pass presorted=True when options are already in display order.
     """
-    extended_opts = ["All"] + sorted(options)
+    extended_opts = ["All"] + (list(options) if presorted else sorted(options))
     default_val = ["All"]
     if sidebar:
         selected = st.sidebar.multiselect(label, extended_opts, default=default_val)
@@ -53,8 +99,20 @@ def multiselect_with_all(label, options, sidebar=True):
 # --------------------------------------------------
 # 1. DATABASE SETUP
 # --------------------------------------------------
+def get_connection():
+    """
+    Opens a connection to the snapshot DB.
+    journal_mode=WAL is persistent (set once in init_db), but synchronous,
+    temp_store and cache_size are connection-local, so every connection re-applies them.
+    """
+    conn = sqlite3.connect(DB_NAME)
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-20000")
+    return conn
+
 def init_db():
-    with sqlite3.connect(DB_NAME) as conn:
+    with get_connection() as conn:
         c = conn.cursor()
         c.execute("""
             CREATE TABLE IF NOT EXISTS options_snapshots (
@@ -69,30 +127,113 @@ def init_db():
                 current_price REAL
             )
         """)
+        # Whole snapshot as a compressed parquet blob, for cheap replay of a single snapshot
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS snapshot_blobs (
+                snapshot_time TEXT PRIMARY KEY,
+                data BLOB
+            )
+        """)
+        c.execute("CREATE INDEX IF NOT EXISTS idx_snap_time ON options_snapshots(snapshot_time)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_snap_sym_time ON options_snapshots(symbol, snapshot_time)")
+        # WAL lets the UI read while the scheduler thread writes,
+        # and turns each commit into a single appended write.
+        conn.execute("PRAGMA journal_mode=WAL")
         conn.commit()
 
 def store_snapshot(df: pd.DataFrame, snapshot_time: str):
     if df.empty:
         return
-    with sqlite3.connect(DB_NAME) as conn:
-        df_to_store = df.copy()
-        df_to_store["snapshot_time"] = snapshot_time
-        df_to_store = df_to_store[
-            [
-                "snapshot_time", "Symbol", "Type", "Expiry",
-                "Strike", "Volume", "Bid", "Ask", "current_price"
-            ]
-        ]
-        df_to_store.to_sql("options_snapshots", conn, if_exists="append", index=False)
+    cols = ["Symbol", "Type", "Expiry", "Strike", "Volume", "Bid", "Ask", "current_price"]
+    rows = [
+        (snapshot_time, *t)
+        for t in df[cols].itertuples(index=False, name=None)
+    ]
+    buf = BytesIO()
+    df[cols].to_parquet(buf, compression="zstd", index=False)
+    # One explicit transaction for the whole snapshot instead of to_sql's chunked inserts
+    with get_connection() as conn:
+        conn.execute("BEGIN")
+        conn.executemany(
+            """
+            INSERT INTO options_snapshots
+                (snapshot_time, symbol, type, expiry, strike, volume, bid, ask, current_price)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            rows
+        )
+        conn.execute(
+            "INSERT OR REPLACE INTO snapshot_blobs (snapshot_time, data) VALUES (?, ?)",
+            (snapshot_time, buf.getvalue())
+        )
+        conn.commit()
 
 def get_latest_snapshot_time():
-    with sqlite3.connect(DB_NAME) as conn:
+    with get_connection() as conn:
         c = conn.cursor()
-        c.execute("SELECT MAX(snapshot_time) FROM options_snapshots")
+        c.execute("SELECT snapshot_time FROM options_snapshots ORDER BY snapshot_time DESC LIMIT 1")
         row = c.fetchone()
         return row[0] if row and row[0] else None
 
-def get_all_snapshots():
+# Compact in-memory dtypes for snapshot frames; SQLite keeps TEXT/REAL either way.
+# The label columns have few distinct values, so category codes replace per-row strings.
+# Prices stay float64 so they reach SQLite and printed alerts without float32 rounding noise.
+SNAPSHOT_DTYPES = {
+    "Symbol": "category",
+    "Type": "category",
+    "Expiry": "category",
+    "Volume": "int32",
+}
+
+def downcast_snapshot(df: pd.DataFrame):
+    """
+    Casts the snapshot columns to SNAPSHOT_DTYPES.
+    Missing volume becomes 0 so it fits an integer column.
+    """
+    if df.empty:
+        return df
+    df["Volume"] = df["Volume"].fillna(0)
+    return df.astype(SNAPSHOT_DTYPES)
+
+# Fixed Arrow dtypes for the Options Flow table, so a column's type never depends on
+# which rows the filters selected (the label columns stay category).
+DISPLAY_ARROW_DTYPES = {
+    "Current Price": "float64[pyarrow]",
+    "Strike": "float64[pyarrow]",
+    "Bid": "float64[pyarrow]",
+    "Ask": "float64[pyarrow]",
+    "Volume": "int32[pyarrow]",
+}
+
+# Display column -> DB column for the Options Flow page filters
+SNAPSHOT_FILTER_COLUMNS = {
+    "Symbol": "symbol",
+    "Type": "type",
+    "Expiry": "expiry",
+    "Strike": "strike",
+}
+
+@st.cache_data(max_entries=16)
+def get_distinct_values(column: str, latest_ts):
+    """
+    Sorted distinct values of a filter column.
+    latest_ts is only part of the cache key, so the list is recomputed once per new snapshot.
+    """
+    db_col = SNAPSHOT_FILTER_COLUMNS[column]
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute(
+            f"SELECT DISTINCT {db_col} FROM options_snapshots "
+            f"WHERE {db_col} IS NOT NULL ORDER BY {db_col}"
+        )
+        return [row[0] for row in c.fetchall()]
+
+def get_all_snapshots(filters=None):
+    """
+    Loads snapshot rows, optionally filtered in SQL.
+    filters maps a display column (see SNAPSHOT_FILTER_COLUMNS) to the allowed values;
+    None means no restriction on that column.
+    """
     query = """
         SELECT snapshot_time,
                symbol AS Symbol,
@@ -105,11 +246,42 @@ def get_all_snapshots():
                current_price AS current_price
           FROM options_snapshots
     """
-    with sqlite3.connect(DB_NAME) as conn:
-        df = pd.read_sql_query(query, conn)
-    return df
+    clauses = []
+    params = []
+    for column, values in (filters or {}).items():
+        if values is None:
+            continue
+        placeholders = ",".join("?" * len(values))
+        clauses.append(f"{SNAPSHOT_FILTER_COLUMNS[column]} IN ({placeholders})")
+        params.extend(values)
+    if clauses:
+        query += " WHERE " + " AND ".join(clauses)
+    # Served by idx_snap_time, so pandas never has to sort the string column
+    query += " ORDER BY snapshot_time"
+
+    with get_connection() as conn:
+        df = pd.read_sql_query(query, conn, params=params)
+    return downcast_snapshot(df)
+
+@st.cache_data(ttl=600, max_entries=8)
+def get_cached_snapshots(latest_ts, filters=None):
+    """
+    get_all_snapshots, memoized across reruns.
+    latest_ts is only part of the cache key: a new snapshot changes it, which misses the cache.
+    """
+    return get_all_snapshots(filters)
 
+# Snapshots are immutable once written, so the timestamp alone is a safe cache key.
+@st.cache_data(max_entries=32)
 def get_snapshot_data(snapshot_time: str):
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT data FROM snapshot_blobs WHERE snapshot_time = ?", (snapshot_time,))
+        row = c.fetchone()
+    if row is not None:
+        return pd.read_parquet(BytesIO(row[0]))
+
+    # Snapshots stored before snapshot_blobs existed only have rows
     query = """
         SELECT symbol AS Symbol,
                type AS Type,
@@ -122,74 +294,306 @@ def get_snapshot_data(snapshot_time: str):
           FROM options_snapshots
          WHERE snapshot_time = ?
     """
-    with sqlite3.connect(DB_NAME) as conn:
+    with get_connection() as conn:
         df = pd.read_sql_query(query, conn, params=[snapshot_time])
-    return df
+    return downcast_snapshot(df)
 
 # --------------------------------------------------
 # 2. FETCHING / COMPARISON
 # --------------------------------------------------
-@st.cache_data(ttl=300)
-def fetch_options_data(symbols):
-    all_data = []
+def get_price_history(symbol, period, interval, after_hours):
+    """
+    Price history via yfinance-cache when installed (disk cache, no network on hits),
+    plain yfinance otherwise.
+    yfinance-cache doesn't cache pre/post-market bars and rejects some period/interval
+    combinations (e.g. 1d of weekly bars), so those requests and any yfc error use plain yfinance.
+    """
+    if yfc is not None and not after_hours:
+        try:
+            return yfc.Ticker(symbol).history(
+                period=period,
+                interval=interval,
+                max_age=INTRADAY_MAX_AGE.get(interval),
+            )
+        except Exception:
+            pass
+    ticker = yf.Ticker(symbol)
+    return ticker.history(period=period, interval=interval, prepost=after_hours)
+
+def _fetch_symbol_meta(ticker):
+    """
+    Returns (current_price, expiries) for a yf.Ticker.
+    current_price is None when fast_info can't price it; see fetch_fallback_prices.
+    """
+    # fast_info hits the lightweight quote endpoint instead of scraping the full info blob
+    try:
+        current_price = ticker.fast_info.get("last_price")
+    except Exception:
+        current_price = None
+    return current_price, list(ticker.options or [])
+
+def fetch_fallback_prices(symbols):
+    """
+    Last close for each symbol from a single batched yf.download,
+    instead of one history() round-trip per symbol.
+    """
+    if not symbols:
+        return {}
+    hist = yf.download(
+        list(symbols), period="1d", group_by="ticker", threads=True, progress=False
+    )
+    prices = {}
     for symbol in symbols:
         try:
-            ticker = yf.Ticker(symbol)
-            current_price = ticker.info.get("regularMarketPrice", None)
-            if current_price is None:
-                hist = ticker.history(period="1d")
-                if not hist.empty:
-                    current_price = hist["Close"].iloc[-1]
-
-            if not ticker.options:
+            closes = hist[symbol]["Close"].dropna()
+        except KeyError:
+            continue
+        if not closes.empty:
+            prices[symbol] = closes.iloc[-1]
+    return prices
+
+# --- async path: one shared aiohttp session against Yahoo's options endpoint ---
+async def _fetch_json(session, url, params=None):
+    async with session.get(url, params=params) as resp:
+        resp.raise_for_status()
+        # Decode the raw bytes directly; skips aiohttp's text decode step
+        return json_loads(await resp.read())
+
+async def _get_crumb(session):
+    """
+    Yahoo's v7 endpoints need the cookie set by fc.yahoo.com plus a matching crumb.
+    """
+    # fc.yahoo.com answers 404 but still sets the cookie, so its status is ignored
+    async with session.get(YAHOO_COOKIE_URL) as resp:
+        await resp.read()
+    async with session.get(YAHOO_CRUMB_URL) as resp:
+        resp.raise_for_status()
+        return await resp.text()
+
+def _expiry_str(timestamp):
+    # Same YYYY-MM-DD (UTC) format yfinance uses for ticker.options
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc).strftime("%Y-%m-%d")
+
+CHAIN_FIELDS = ["strike", "volume", "bid", "ask"]
+
+def _chain_frame(contracts):
+    """
+    Builds the chain DataFrame straight from the JSON contract list as float columns,
+    reading only the fields we keep (missing/null -> NaN) instead of inferring
+    a frame from every key of every contract dict.
+    """
+    return pd.DataFrame({
+        field: np.array([c.get(field) for c in contracts], dtype=float)
+        for field in CHAIN_FIELDS
+    })
+
+async def _fetch_json_throttled(session, limiter, url, params=None):
+    async with limiter:
+        try:
+            return await _fetch_json(session, url, params)
+        finally:
+            await asyncio.sleep(REQUEST_DELAY_SEC)
+
+async def _fetch_symbol_chains(session, limiter, symbol, crumb, warn):
+    """
+    Returns (current_price, chains) where chains is a list of (expiry, opt_type, chain_df).
+    The first response carries the expiry list and the nearest expiry's chain;
+    the remaining expiries are requested concurrently.
+    """
+    url = YAHOO_OPTIONS_URL.format(symbol=symbol)
+    first = await _fetch_json_throttled(session, limiter, url, {"crumb": crumb})
+    result = first["optionChain"]["result"][0]
+    current_price = result.get("quote", {}).get("regularMarketPrice")
+
+    pages = [result]
+    expiries = result.get("expirationDates", [])
+    responses = await asyncio.gather(
+        *[
+            _fetch_json_throttled(session, limiter, url, {"date": d, "crumb": crumb})
+            for d in expiries[1:]
+        ],
+        return_exceptions=True
+    )
+    for expiry, resp in zip(expiries[1:], responses):
+        if isinstance(resp, Exception):
+            warn(f"Error fetching data for {symbol} ({_expiry_str(expiry)}): {resp}")
+            continue
+        pages.append(resp["optionChain"]["result"][0])
+
+    chains = []
+    for page in pages:
+        for chain in page.get("options", []):
+            expiry = _expiry_str(chain["expirationDate"])
+            chains.append((expiry, "Call", _chain_frame(chain.get("calls", []))))
+            chains.append((expiry, "Put", _chain_frame(chain.get("puts", []))))
+    return current_price, chains
+
+async def fetch_options_async(symbols, warn):
+    """
+    Fetches every (symbol, expiry) chain concurrently on one event loop.
+    A single ClientSession keeps the connection pool (and TLS sessions) alive across requests.
+    Returns (prices, chains, failures); failures maps each symbol that could not be fetched
+    to its error, so the caller can decide whether it is worth reporting.
+    """
+    connector = aiohttp.TCPConnector(limit=MAX_CONNECTIONS)
+    limiter = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    async with aiohttp.ClientSession(
+        connector=connector,
+        headers={"User-Agent": USER_AGENT},
+        timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT_SEC)
+    ) as session:
+        crumb = await _get_crumb(session)
+        results = await asyncio.gather(
+            *[_fetch_symbol_chains(session, limiter, symbol, crumb, warn) for symbol in symbols],
+            return_exceptions=True
+        )
+
+    prices = {}
+    chains = []
+    failures = {}
+    for symbol, result in zip(symbols, results):
+        if isinstance(result, Exception):
+            failures[symbol] = result
+            continue
+        prices[symbol], symbol_chains = result
+        chains.extend((symbol, *chain) for chain in symbol_chains)
+    return prices, chains, failures
+
+# --- threaded yfinance path, used when the direct endpoint is unavailable ---
+def _fetch_chain(ticker, expiry):
+    opt_chain = ticker.option_chain(expiry)
+    # Courtesy delay per worker so we don't hammer Yahoo
+    time.sleep(0.2)
+    return opt_chain
+
+def fetch_options_threaded(symbols, warn):
+    """
+    Fans the per-symbol and per-(symbol, expiry) yfinance calls out over a thread pool.
+    Returns (prices, chains) in the same shape as fetch_options_async, reporting failures via warn.
+    """
+    prices = {}
+    chains = []
+    # One Ticker per symbol for the whole fetch, shared by its meta and chain requests
+    tickers = {symbol: yf.Ticker(symbol) for symbol in symbols}
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as pool:
+        meta_futures = [
+            (symbol, pool.submit(_fetch_symbol_meta, tickers[symbol])) for symbol in symbols
+        ]
+
+        chain_futures = []
+        for symbol, future in meta_futures:
+            try:
+                prices[symbol], expiries = future.result()
+            except Exception as e:
+                warn(f"Error fetching data for {symbol}: {e}")
                 continue
+            for expiry in expiries:
+                chain_futures.append(
+                    (symbol, expiry, pool.submit(_fetch_chain, tickers[symbol], expiry))
+                )
 
-            for expiry in ticker.options:
-                opt_chain = ticker.option_chain(expiry)
-                for opt_type, chain_df in [("Call", opt_chain.calls), ("Put", opt_chain.puts)]:
-                    for _, row in chain_df.iterrows():
-                        all_data.append({
-                            "Symbol": symbol,
-                            "Type": opt_type,
-                            "Expiry": expiry,
-                            "Strike": row.get("strike", 0),
-                            "Volume": row.get("volume", 0),
-                            "Bid": row.get("bid", 0),
-                            "Ask": row.get("ask", 0),
-                            "current_price": current_price,
-                        })
-            time.sleep(0.2)
-        except Exception as e:
-            st.warning(f"Error fetching data for {symbol}: {e}")
-
-    df = pd.DataFrame(all_data)
+        for symbol, expiry, future in chain_futures:
+            try:
+                opt_chain = future.result()
+            except Exception as e:
+                warn(f"Error fetching data for {symbol} ({expiry}): {e}")
+                continue
+            chains.append((symbol, expiry, "Call", opt_chain.calls))
+            chains.append((symbol, expiry, "Put", opt_chain.puts))
+    return prices, chains
+
+def _fetch_options_data_impl(symbols):
+    """
+    Fetches all option chains for symbols into one snapshot DataFrame.
+    Returns (df, errors); showing the error messages is left to the caller.
+    """
+    errors = []
+    warn = errors.append
+    try:
+        prices, chains, failures = asyncio.run(fetch_options_async(symbols, warn))
+    except Exception as e:
+        prices, chains = {}, []
+        failures = {symbol: e for symbol in symbols}
+
+    # Symbols the direct endpoint rejected (e.g. a 401 per request) go through yfinance;
+    # their direct-endpoint errors only matter if yfinance can't recover them either
+    failed = [symbol for symbol in symbols if symbol not in prices]
+    if failed:
+        fallback_prices, fallback_chains = fetch_options_threaded(failed, warn)
+        prices.update(fallback_prices)
+        chains.extend(fallback_chains)
+        for symbol in failed:
+            if symbol not in fallback_prices:
+                warn(f"Direct Yahoo fetch also failed for {symbol}: {failures[symbol]}")
+
+    # One batched request covers every symbol the quote lookup couldn't price
+    unpriced = [symbol for symbol, price in prices.items() if price is None]
+    try:
+        prices.update(fetch_fallback_prices(unpriced))
+    except Exception as e:
+        warn(f"Error fetching fallback prices for {', '.join(unpriced)}: {e}")
+
+    if not chains:
+        return pd.DataFrame([]), errors
+
+    # Concatenate the raw chains once, then broadcast the per-chain labels
+    # with np.repeat instead of assigning four columns on every chunk.
+    df = pd.concat(
+        [chain_df.reindex(columns=CHAIN_FIELDS, fill_value=0)
+         for _, _, _, chain_df in chains],
+        ignore_index=True
+    ).rename(
+        columns={"strike": "Strike", "volume": "Volume", "bid": "Bid", "ask": "Ask"}
+    ).fillna({"Volume": 0, "Bid": 0.0, "Ask": 0.0})
+    lengths = [len(chain_df) for _, _, _, chain_df in chains]
+    df["Symbol"] = np.repeat([symbol for symbol, _, _, _ in chains], lengths)
+    df["Type"] = np.repeat([opt_type for _, _, opt_type, _ in chains], lengths)
+    df["Expiry"] = np.repeat([expiry for _, expiry, _, _ in chains], lengths)
+    df["current_price"] = np.repeat(
+        np.array([prices.get(symbol) for symbol, _, _, _ in chains], dtype=float), lengths
+    )
+
+    df = downcast_snapshot(df)
     if not df.empty:
         df.sort_values("Volume", ascending=False, inplace=True)
-    return df
+    return df, errors
+
+@st.cache_data(ttl=REFRESH_INTERVAL_SEC, show_spinner="Fetching options...")
+def fetch_options_data(symbols: tuple):
+    """
+    Cached entrypoint for the UI. symbols must be a tuple so it is hashable.
+    No st.* calls in here: a cache hit must not depend on replaying widgets.
+    """
+    return _fetch_options_data_impl(symbols)
 
 def find_unusual_volume(new_df, old_df, ratio_thr, diff_thr):
     if new_df.empty or old_df.empty:
         return pd.DataFrame([])
 
     keys = ["Symbol", "Type", "Expiry", "Strike"]
-    merged = pd.merge(new_df, old_df, on=keys, how="outer", suffixes=("", "_old"))
-
-    merged["Volume"] = merged["Volume"].fillna(0)
-    merged["Volume_old"] = merged["Volume_old"].fillna(0)
-
-    merged["Volume_Diff"] = merged["Volume"] - merged["Volume_old"]
-    def ratio_func(row):
-        if row["Volume_old"] > 0:
-            return row["Volume"] / row["Volume_old"]
-        else:
-            return float("inf")
-    merged["Volume_Ratio"] = merged.apply(ratio_func, axis=1)
+    # Only contracts in the new snapshot can be unusual; ones new since the old snapshot get Volume_old = 0.
+    # A dict keyed on the contract tuple is cheaper than a 4-column hash merge here.
+    old_lookup = dict(zip(zip(*(old_df[k] for k in keys)), old_df["Volume"]))
+    old_vol = np.fromiter(
+        (old_lookup.get(key, 0.0) for key in zip(*(new_df[k] for k in keys))),
+        dtype=float,
+        count=len(new_df)
+    )
 
-    condition = (
-        (merged["Volume_Ratio"] >= ratio_thr) &
-        (merged["Volume_Diff"] >= diff_thr)
+    new_vol = new_df["Volume"].to_numpy(dtype=float)
+    diff = new_vol - old_vol
+    has_old = old_vol > 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = np.where(has_old, new_vol / np.where(has_old, old_vol, 1), np.inf)
+
+    # One fused mask over the raw arrays. Only the matching rows are materialized;
+    # new_df itself is never copied or mutated.
+    condition = (ratio >= ratio_thr) & (diff >= diff_thr)
+    unusual = new_df.loc[condition].assign(
+        Volume_old=old_vol[condition],
+        Volume_Diff=diff[condition],
+        Volume_Ratio=ratio[condition],
     )
-    unusual = merged[condition].copy()
 
     if unusual.empty:
         return unusual
@@ -200,8 +604,7 @@ def find_unusual_volume(new_df, old_df, ratio_thr, diff_thr):
         "Bid", "Ask", "current_price"
     ]
     existing_cols = [c for c in keep_cols if c in unusual.columns]
-    unusual = unusual[condition][existing_cols].sort_values("Volume_Diff", ascending=False)
-    return unusual
+    return unusual[existing_cols].sort_values("Volume_Diff", ascending=False)
 
 # --------------------------------------------------
 # 3. ALERTS
@@ -217,21 +620,35 @@ def send_alerts(unusual_df):
 # --------------------------------------------------
 # 4. BACKGROUND SCHEDULER
 # --------------------------------------------------
-def background_fetch_job():
+def background_fetch_job(stop_event):
+    """
+    Runs on a daemon thread: fetch, store, alert, then wait for the next tick.
+    Only touches SQLite and stdout; Streamlit API calls stay on the script thread.
+    """
+    interval_minutes = 1
+    # The snapshot this job stored last tick; reused as the comparison base
+    # unless something else (e.g. a manual fetch) has stored a newer one since.
+    prev_time, prev_df = None, None
     while True:
-        interval_minutes = 1
+        # Deadline fixed at the start of the pass, so fetch time doesn't stretch the period
+        next_run = time.monotonic() + 60 * interval_minutes
         try:
-            fetch_options_data.clear()
-            new_snapshot_df = fetch_options_data(SYMBOLS)
+            # Bypass the UI's st.cache_data entry so the scheduler never invalidates it
+            new_snapshot_df, errors = _fetch_options_data_impl(SYMBOLS)
+            for msg in errors:
+                print(f"[Scheduler] {msg}")
 
             now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             if not new_snapshot_df.empty:
                 old_time = get_latest_snapshot_time()
                 old_df = pd.DataFrame([])
-                if old_time:
+                if old_time and old_time == prev_time:
+                    old_df = prev_df
+                elif old_time:
                     old_df = get_snapshot_data(old_time)
 
                 store_snapshot(new_snapshot_df, now_str)
+                prev_time, prev_df = now_str, new_snapshot_df
 
                 ratio_thr = 2.0
                 diff_thr = 1000
@@ -246,18 +663,31 @@ def background_fetch_job():
         except Exception as ex:
             print(f"[Scheduler] Error: {ex}")
 
-        for _ in range(interval_minutes * 6):
-            time.sleep(10)
+        # Returns True as soon as stop_scheduler() sets the event
+        if stop_event.wait(max(0, next_run - time.monotonic())):
+            print("[Scheduler] Stopped.")
+            return
 
 def start_scheduler():
     if st.session_state.scheduler_running:
         st.write("Scheduler is already running.")
         return
+    # Module globals are re-created on every rerun, so the event lives in session_state
+    stop_event = threading.Event()
+    st.session_state.scheduler_stop = stop_event
     st.session_state.scheduler_running = True
-    thread = threading.Thread(target=background_fetch_job, daemon=True)
+    thread = threading.Thread(target=background_fetch_job, args=(stop_event,), daemon=True)
     thread.start()
     st.write("Background scheduler thread started.")
 
+def stop_scheduler():
+    if not st.session_state.scheduler_running:
+        st.write("Scheduler is not running.")
+        return
+    st.session_state.scheduler_stop.set()
+    st.session_state.scheduler_running = False
+    st.write("Background scheduler stopped.")
+
 # --------------------------------------------------
 # PAGE 1: Options Flow Tracker
 # --------------------------------------------------
@@ -270,35 +700,26 @@ def page_options_flow():
     with tab1:
         st.subheader("Filtered Options Data")
 
-        # --- Load all snapshots ---
-        df_all = get_all_snapshots()
-        if df_all.empty:
+        latest_ts = get_latest_snapshot_time()
+        if latest_ts is None:
             st.info("No snapshots in DB yet. Go to 'Settings' tab to fetch data.")
             return
 
-        df_all.sort_values("snapshot_time", inplace=True)
-
         st.sidebar.header("Filters")
-        # Symbol
-        unique_symbols = df_all["Symbol"].unique()
-        selected_symbols = multiselect_with_all("Symbols", unique_symbols)
-        # Type
-        unique_types = df_all["Type"].unique()
-        selected_types = multiselect_with_all("Option Types", unique_types)
-        # Expiry
-        unique_expiries = df_all["Expiry"].unique()
-        selected_expiries = multiselect_with_all("Expiries", unique_expiries)
-        # Strike
-        unique_strikes = df_all["Strike"].unique().astype(str)
-        selected_strikes = multiselect_with_all("Strikes", unique_strikes)
-
-        filtered = df_all[
-            df_all["Symbol"].isin(selected_symbols) &
-            df_all["Type"].isin(selected_types) &
-            df_all["Expiry"].isin(selected_expiries)
-        ].copy()
-        filtered["Strike_str"] = filtered["Strike"].astype(str)
-        filtered = filtered[filtered["Strike_str"].isin(selected_strikes)]
+        filters = {}
+        for column, label in [
+            ("Symbol", "Symbols"),
+            ("Type", "Option Types"),
+            ("Expiry", "Expiries"),
+            ("Strike", "Strikes"),
+        ]:
+            options = get_distinct_values(column, latest_ts)
+            selected = multiselect_with_all(label, options, presorted=True)
+            # "All" needs no WHERE clause (and keeps the strike IN-list short)
+            filters[column] = None if len(selected) == len(options) else selected
+
+        # --- Load only the matching snapshot rows ---
+        filtered = get_cached_snapshots(latest_ts, filters)
 
         if filtered.empty:
             st.warning("No data matching the selected filters.")
@@ -309,9 +730,9 @@ def page_options_flow():
                 inplace=True
             )
             # Sort by Volume desc
-            filtered = filtered.sort_values("Volume", ascending=False)
+            filtered.sort_values("Volume", ascending=False, inplace=True)
 
-            # Reorder columns
+            # Reorder columns (filtered is already our own frame, so no defensive copies)
             filtered.rename(columns={"Expiry":"Expiry Date"}, inplace=True)
             final_cols = [
                 "Symbol",
@@ -324,22 +745,41 @@ def page_options_flow():
                 "Volume"
             ]
             existing_cols = [c for c in final_cols if c in filtered.columns]
-            display_df = filtered[existing_cols].copy()
-            display_df.rename(columns={"current_price":"Current Price"}, inplace=True)
-            display_df.drop(columns=["Strike_str"], errors="ignore", inplace=True)
+            # Arrow-backed columns let st.dataframe hand the table to the browser
+            # without its own pandas -> Arrow conversion pass.
+            display_df = (
+                filtered[existing_cols]
+                .rename(columns={"current_price":"Current Price"})
+                .astype(DISPLAY_ARROW_DTYPES)
+            )
 
-            st.dataframe(display_df.reset_index(drop=True))
+            # Formatting happens in the browser, not as per-row Python string formatting
+            price_format = st.column_config.NumberColumn(format="%.2f")
+            st.dataframe(
+                display_df,
+                hide_index=True,
+                column_config={
+                    "Current Price": price_format,
+                    "Strike": price_format,
+                    "Bid": price_format,
+                    "Ask": price_format,
+                }
+            )
 
     with tab2:
         # This is the old "Settings" page content
         st.subheader("Scheduler Controls")
         if st.button("Start Background Scheduler"):
             start_scheduler()
+        if st.button("Stop Background Scheduler"):
+            stop_scheduler()
 
         st.subheader("Manual Snapshot Fetch")
         if st.button("Fetch Snapshot Now"):
             fetch_options_data.clear()
-            new_snapshot = fetch_options_data(SYMBOLS)
+            new_snapshot, errors = fetch_options_data(tuple(SYMBOLS))
+            for msg in errors:
+                st.warning(msg)
             now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
             if new_snapshot.empty:
@@ -372,31 +812,57 @@ def page_options_flow():
 # --------------------------------------------------
 # PAGE 2: Stock Chart
 # --------------------------------------------------
-@st.cache_data
+CHART_SYMBOLS = ["AAPL","MSFT","TSLA","SPY","QQQ"]
+
+@st.cache_data(ttl=60)
 def load_stock_data(symbol, period, interval, after_hours, refresh_counter):
     """
     The combination of these arguments forms the cache key.
     Changing any => re-fetch from yfinance.
     """
-    ticker = yf.Ticker(symbol)
-    df = ticker.history(period=period, interval=interval, prepost=after_hours)
+    df = get_price_history(symbol, period, interval, after_hours)
     return df
 
-@st.cache_data(ttl=300)
-def fetch_stock_history(symbol, period, interval, after_hours):
-    ticker = yf.Ticker(symbol)
-    return ticker.history(period=period, interval=interval, prepost=after_hours)
+@st.cache_resource(ttl=60, max_entries=32)
+def build_stock_figure(symbol, period, interval, after_hours, refresh_counter, chart_type):
+    """
+    The chart figure, keyed like load_stock_data plus chart_type.
+    cache_resource hands back the same Figure object, so reruns skip rebuilding the traces
+    (and the Figure never has to be pickled, as st.cache_data would need).
+    """
+    df = load_stock_data(symbol, period, interval, after_hours, refresh_counter)
+    fig = go.Figure()
+    if chart_type == "Line":
+        fig.add_trace(go.Scatter(x=df.index, y=df["Close"], mode="lines", name="Close"))
+    else:
+        fig.add_trace(
+            go.Candlestick(
+                x=df.index,
+                open=df["Open"],
+                high=df["High"],
+                low=df["Low"],
+                close=df["Close"],
+                name=symbol
+            )
+        )
+
+    fig.update_layout(
+        title=f"{symbol} - {period} ({interval})",
+        xaxis_title="Date",
+        yaxis_title="Price",
+        hovermode="x unified"
+    )
+    return fig
 
 def page_stock_chart():
     if "stock_refresh" not in st.session_state:
         st.session_state["stock_refresh"] = 0
 
-    SYMBOLS = ["AAPL","MSFT","TSLA","SPY","QQQ"]
     PERIODS = ["1d","5d","1mo","6mo","1y","5y","max"]
     INTERVALS = ["1m","5m","15m","30m","1h","1d","1wk","1mo"]
 
     st.sidebar.header("Filters (Stock Chart)")
-    symbol = st.sidebar.selectbox("Symbol", SYMBOLS, index=1)  # e.g. "MSFT"
+    symbol = st.sidebar.selectbox("Symbol", CHART_SYMBOLS, index=1)  # e.g. "MSFT"
     period = st.sidebar.selectbox("Period", PERIODS, index=3)  # e.g. "1d"
     interval = st.sidebar.selectbox("Interval", INTERVALS, index=2)  # e.g. "15m"
     after_hours = st.sidebar.checkbox("Include After-Hours Data?", value=False)
@@ -406,51 +872,40 @@ def page_stock_chart():
     if st.sidebar.button("Refresh Now"):
         st.session_state["stock_refresh"] += 1
 
-    auto_refresh = st.sidebar.checkbox("Auto-refresh every 15 seconds", value=False)
+    AUTO_REFRESH_SEC = 15
+    auto_refresh = st.sidebar.checkbox(f"Auto-refresh every {AUTO_REFRESH_SEC} seconds", value=False)
 
     # Clear cache button
     if st.sidebar.button("Clear Cache"):
         load_stock_data.clear()
+        build_stock_figure.clear()
+
+    # Rendered as a fragment: with auto-refresh on, Streamlit reruns just this part
+    # every AUTO_REFRESH_SEC without blocking the script thread or queued widget events.
+    def render_chart():
+        refresh_key = st.session_state["stock_refresh"]
+        if auto_refresh:
+            # Each new time bucket is a new cache key, so every tick refetches
+            refresh_key = (refresh_key, int(time.time() // AUTO_REFRESH_SEC))
 
-    # Fetch data
-    if symbol:
         with st.spinner("Loading stock chart..."):
-            df = load_stock_data(symbol, period, interval, after_hours, st.session_state["stock_refresh"])
+            df = load_stock_data(symbol, period, interval, after_hours, refresh_key)
 
         if df.empty:
             st.warning(f"No price data found for {symbol}.")
         else:
             st.header("Stock Chart & Price (Line or Candlestick)")
             st.write(f"**Symbol**: {symbol}, **Last Price**: {df['Close'].iloc[-1]:.2f}")
-            # Build chart
-            fig = go.Figure()
-            if chart_type == "Line":
-                fig.add_trace(go.Scatter(x=df.index, y=df["Close"], mode="lines", name="Close"))
-            else:
-                fig.add_trace(
-                    go.Candlestick(
-                        x=df.index,
-                        open=df["Open"],
-                        high=df["High"],
-                        low=df["Low"],
-                        close=df["Close"],
-                        name=symbol
-                    )
-                )
-
-            fig.update_layout(
-                title=f"{symbol} - {period} ({interval})",
-                xaxis_title="Date",
-                yaxis_title="Price",
-                hovermode="x unified"
+            fig = build_stock_figure(
+                symbol, period, interval, after_hours, refresh_key, chart_type
             )
             st.plotly_chart(fig, use_container_width=True)
 
             st.dataframe(df.tail(10))
 
-    if auto_refresh:
-        time.sleep(15)
-        st.session_state["stock_refresh"] += 1
+    if symbol:
+        st.fragment(run_every=AUTO_REFRESH_SEC if auto_refresh else None)(render_chart)()
+
 # --------------------------------------------------
 # MAIN
 # --------------------------------------------------